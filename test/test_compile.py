@@ -4,6 +4,7 @@
 def test_compile():
     try:
         import tiddlywebplugins.etagcache
+        import tiddlywebplugins.etagcachetools
         assert True
     except ImportError, exc:
         assert False, exc
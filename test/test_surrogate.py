@@ -0,0 +1,160 @@
+
+import httplib2
+from wsgi_intercept import httplib2_intercept
+import wsgi_intercept
+from tiddlyweb.web.serve import load_app
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+from tiddlywebplugins.etagcache import PURGE_QUEUE
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import shutil
+import threading
+import time
+
+
+PURGES = []
+
+
+class StubProxyHandler(BaseHTTPRequestHandler):
+    """
+    Record purge requests as a reverse proxy would receive them.
+    """
+
+    def do_PURGE(self):
+        PURGES.append(self.headers.get('Surrogate-Key'))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def setup_module(module):
+    # cleanup
+    try:
+        shutil.rmtree('store')
+    except OSError:
+        pass
+
+    # establish stub proxy
+    proxy = HTTPServer(('127.0.0.1', 0), StubProxyHandler)
+    thread = threading.Thread(target=proxy.serve_forever)
+    thread.daemon = True
+    thread.start()
+    module.proxy = proxy
+
+    config['etagcache.surrogate_keys'] = True
+    config['etagcache.purge_uri'] = 'http://127.0.0.1:%s/' % (
+            proxy.server_address[1])
+    config['etagcache.purge_interval'] = 0
+
+    # establish web server
+    app = load_app()
+    def app_fn():
+        return app
+    httplib2_intercept.install()
+    wsgi_intercept.add_wsgi_intercept('our_test_domain', 8001, app_fn)
+
+    # establish store
+    store = Store(config['server_store'][0], config['server_store'][1],
+            environ={'tiddlyweb.config': config})
+
+    bag = Bag('surrogate')
+    store.put(bag)
+    bag = Bag('sur(rogate)')
+    store.put(bag)
+
+    module.store = store
+    module.http = httplib2.Http()
+
+
+def teardown_module(module):
+    module.proxy.shutdown()
+    for key in ['etagcache.surrogate_keys', 'etagcache.purge_uri',
+            'etagcache.purge_interval']:
+        del config[key]
+
+
+def _wait_for_purge(surrogate_key, timeout=5):
+    """
+    Purges are sent from a timer thread, so wait for one naming
+    surrogate_key to reach the stub proxy.
+    """
+    finish = time.time() + timeout
+    while time.time() < finish:
+        for purge in PURGES:
+            if surrogate_key in purge.split():
+                return True
+        time.sleep(0.05)
+    return False
+
+
+def _check_purged(bag_name):
+    tiddler = Tiddler('one', bag_name)
+    tiddler.text = 'hi'
+    store.put(tiddler)
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/%s/tiddlers/one' % bag_name)
+    assert response['status'] == '200'
+    surrogate_key = response['surrogate-key']
+    assert surrogate_key
+
+    del PURGES[:]
+    tiddler.text = 'bye'
+    store.put(tiddler)
+
+    assert _wait_for_purge(surrogate_key)
+
+
+def test_surrogate_key_purged():
+    _check_purged('surrogate')
+
+
+def test_quoted_surrogate_key_purged():
+    _check_purged('sur(rogate)')
+
+
+def test_no_surrogate_key_on_miss():
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/surrogate/tiddlers/missing')
+    assert response['status'] == '404'
+    assert 'surrogate-key' not in response
+
+
+def test_purges_batched():
+    surrogate_keys = []
+    tiddlers = []
+    for bag_name in ['surrogate', 'sur(rogate)']:
+        tiddler = Tiddler('two', bag_name)
+        tiddler.text = 'hi'
+        store.put(tiddler)
+        tiddlers.append(tiddler)
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/%s/tiddlers/two'
+                % bag_name)
+        assert response['status'] == '200'
+        surrogate_keys.append(response['surrogate-key'])
+    assert _wait_for_purge(surrogate_keys[1])
+
+    config['etagcache.purge_interval'] = 0.5
+    try:
+        # pretend a purge was just sent, so the next must wait
+        PURGE_QUEUE.last_sent = time.time()
+        del PURGES[:]
+        for tiddler in tiddlers:
+            tiddler.text = 'bye'
+            store.put(tiddler)
+        assert not PURGES # held for the interval
+        assert _wait_for_purge(surrogate_keys[0])
+        assert len(PURGES) == 1
+        assert surrogate_keys[1] in PURGES[0].split()
+    finally:
+        config['etagcache.purge_interval'] = 0
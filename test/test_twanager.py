@@ -0,0 +1,181 @@
+
+import httplib2
+from wsgi_intercept import httplib2_intercept
+import wsgi_intercept
+from tiddlyweb.web.serve import load_app
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+from tiddlyweb.manage import handle
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+import os
+import shutil
+import sys
+
+from StringIO import StringIO
+
+import simplejson
+
+import tiddlywebplugins.etagcache
+from tiddlywebplugins.etagcachetools import parse_policy
+
+
+def setup_module(module):
+    # cleanup
+    try:
+        shutil.rmtree('store')
+    except OSError:
+        pass
+
+    config['etagcache.registry'] = True
+    config['etagcache.registry_sample'] = 1
+    config['etagcache.capture'] = 'capture.log'
+    try:
+        os.unlink('capture.log')
+    except OSError:
+        pass
+
+    # establish web server
+    app = load_app()
+    def app_fn():
+        return app
+    httplib2_intercept.install()
+    wsgi_intercept.add_wsgi_intercept('our_test_domain', 8001, app_fn)
+
+    # establish store
+    store = Store(config['server_store'][0], config['server_store'][1],
+            environ={'tiddlyweb.config': config})
+
+    bag = Bag('registered')
+    store.put(bag)
+    for i in range(3):
+        tiddler = Tiddler('tiddler%s' % i, 'registered')
+        tiddler.text = 'hi'
+        store.put(tiddler)
+
+    # register the twanager commands
+    twanager_config = dict(config)
+    twanager_config.pop('selector', None)
+    tiddlywebplugins.etagcache.init(twanager_config)
+
+    module.store = store
+    module.http = httplib2.Http()
+
+
+def teardown_module(module):
+    for key in ['etagcache.registry', 'etagcache.registry_sample',
+            'etagcache.capture']:
+        del config[key]
+    capture_logger = tiddlywebplugins.etagcache.CAPTURE_LOGGER
+    for handler in capture_logger.handlers[:]:
+        handler.close()
+        capture_logger.removeHandler(handler)
+    for filename in os.listdir('.'):
+        if filename.startswith('capture.log'):
+            os.unlink(filename)
+
+
+def _twanager(command, *args):
+    output = StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        handle(['twanager', command] + list(args))
+    finally:
+        sys.stdout = stdout
+    return output.getvalue()
+
+
+def test_stats():
+    for i in range(3):
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/registered/tiddlers/'
+                'tiddler%s' % i)
+        assert response['status'] == '200'
+    response, content = http.request('http://our_test_domain:8001/bags')
+    assert response['status'] == '200'
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/registered/tiddlers/tiddler0',
+            headers={'If-None-Match': response['etag'].replace('"', '')})
+    assert response['status'] == '200'
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/registered/tiddlers/tiddler0')
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/registered/tiddlers/tiddler0',
+            headers={'If-None-Match': response['etag']})
+    assert response['status'] == '304'
+
+    output = _twanager('etagcachestats')
+    lines = dict((line.split()[0], line.split())
+            for line in output.splitlines())
+    assert int(lines['bag'][1]) >= 3
+    assert int(lines['bag'][2]) >= 3
+    assert int(lines['bags'][2]) >= 1
+    assert int(lines['bag'][10]) >= 2 # conditional lookups of entries
+    assert int(lines['bag'][11]) >= 1 # answered from the cache
+
+    tiddler = Tiddler('tiddler0', 'registered')
+    tiddler.text = 'bye'
+    store.put(tiddler)
+
+    output = _twanager('etagcachestats')
+    lines = dict((line.split()[0], line.split())
+            for line in output.splitlines())
+    assert int(lines['bag'][3]) >= 3 # namespace bumped, entries stale
+
+
+def test_namespaces():
+    output = _twanager('etagcachenamespaces')
+    assert 'registered' in output
+
+
+def test_simulate():
+    uri = 'http://our_test_domain:8001/bags/registered/tiddlers/tiddler1'
+    response, content = http.request(uri)
+    etag = response['etag']
+    for i in range(5):
+        response, content = http.request(uri,
+                headers={'If-None-Match': etag})
+        assert response['status'] == '304'
+
+    response, content = http.request(uri,
+            headers={'If-None-Match': '"not/current/0:etag"'})
+    assert response['status'] == '200'
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/registered/tiddlers/missing')
+    assert response['status'] == '404' # raised by the handler
+
+    records = [simplejson.loads(line) for line in open('capture.log')]
+    requests = [record for record in records if record[0] == 'r']
+    assert [record[14] for record in requests
+            if record[11].endswith('/tiddler1')
+            and record[4] == 200 and record[3]] == [0]
+    assert [record[4] for record in requests
+            if record[11].endswith('/missing')] == [404]
+
+    output = _twanager('etagcachesimulate', 'capture.log',
+            'granularity=global,l1=100')
+    lines = output.splitlines()
+    assert lines[0].startswith('observed: ')
+    current = lines[2].split()
+    assert current[-1] == 'current'
+    assert int(current[2]) >= 5 # hits
+    assert lines[3].split()[-1] == 'granularity=global,l1=100'
+
+
+def test_parse_policy():
+    assert parse_policy('granularity=class,ttl=300,negative=on') == {
+            'granularity': 'class', 'ttl': 300, 'negative': True}
+    for text in ['granularity=bag', 'admission=third', 'size=10']:
+        try:
+            parse_policy(text)
+            assert False, text
+        except ValueError:
+            pass
+
+    output = _twanager('etagcachesimulate', 'capture.log',
+            'admission=third')
+    assert output == ''
@@ -10,10 +10,15 @@ from tiddlyweb.store import Store
 from tiddlyweb.model.bag import Bag
 from tiddlyweb.model.recipe import Recipe
 from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.web.negotiate import figure_type
+
+from tiddlywebplugins.etagcache import _get_uri, _make_key, NEGATIVE_ENTRY
 
 import os
 import shutil
 
+import simplejson
+
 def setup_module(module):
     # cleanup
     try:
@@ -264,3 +269,223 @@ def test_bad_encoding():
     response, content = http.request(
             'http://our_test_domain:8001/search?q=tag:\"\xe8\xb3\x87\xe8\xa8\x8a\xe6\x89\x8b\xe8\xa8\x98\"')
     assert response['status'] == '200', content
+
+
+def test_if_match():
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/two',
+            headers={'Accept': 'application/json'})
+    assert response['status'] == '200'
+    etag = response['etag']
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/two',
+            method='PUT',
+            headers={'Content-Type': 'application/json',
+                'If-Match': etag.replace('/two/', '/two/0')},
+            body='{"text": "stale"}')
+    assert response['status'] == '412' # failed from cache
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/two',
+            method='PUT',
+            headers={'Content-Type': 'application/json',
+                'If-Match': etag},
+            body='{"text": "fresh"}')
+    assert response['status'] == '204'
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/two',
+            method='PUT',
+            headers={'Content-Type': 'application/json',
+                'If-Match': etag},
+            body='{"text": "stale"}')
+    assert response['status'] == '412' # etag changed with the put
+
+
+def test_if_match_quoted_bag():
+    bag = Bag('my place')
+    store.put(bag)
+    tiddler = Tiddler('three', 'my place')
+    tiddler.text = 'hi'
+    store.put(tiddler)
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/my%20place/tiddlers/three',
+            headers={'Accept': 'application/json'})
+    assert response['status'] == '200'
+    etag = response['etag']
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/my%20place/tiddlers/three',
+            method='PUT',
+            headers={'Content-Type': 'application/json',
+                'If-Match': etag},
+            body='{"text": "once"}')
+    assert response['status'] == '204'
+    etag = response['etag']
+
+    # the put must have invalidated the cached etag
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/my%20place/tiddlers/three',
+            method='PUT',
+            headers={'Content-Type': 'application/json',
+                'If-Match': etag},
+            body='{"text": "twice"}')
+    assert response['status'] == '204', content
+
+
+def test_if_match_from_cache():
+    """
+    Plant a cached ETag that disagrees with the store. If the
+    412 comes back, the cache was used rather than the store.
+    """
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/two',
+            headers={'Accept': 'application/json'})
+    assert response['status'] == '200'
+    etag = response['etag']
+
+    store.storage.mc.set(_cache_key('/bags/place/tiddlers/two',
+        {'HTTP_ACCEPT': 'application/json'}),
+        [('ETag', '"place/two/999:planted"')])
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/two',
+            method='PUT',
+            headers={'Content-Type': 'application/json',
+                'If-Match': etag},
+            body='{"text": "current"}')
+    assert response['status'] == '412' # the store would have said 204
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/one')
+    assert response['status'] == '200'
+    etag = response['etag']
+
+    store.storage.mc.set(_cache_key('/bags/place/tiddlers/one'),
+        [('ETag', '"place/one/999:planted"')])
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/one',
+            method='DELETE',
+            headers={'If-Match': etag})
+    assert response['status'] == '412' # DELETE found the GET entry
+
+    # put things back for later tests
+    tiddler = Tiddler('one', 'place')
+    tiddler.text = 'hi'
+    store.put(tiddler)
+
+
+def test_validate_etags():
+    response, content = http.request(
+            'http://our_test_domain:8001/bags/place/tiddlers/one')
+    assert response['status'] == '200'
+    etag = response['etag']
+
+    response, content = http.request(
+            'http://our_test_domain:8001/bags')
+    assert response['status'] == '200'
+    bags_etag = response['etag']
+
+    body = simplejson.dumps([
+        ['/bags/place/tiddlers/one', etag],
+        ['/bags', bags_etag],
+        ['/bags/place/tiddlers/two', etag],
+        ['/bags/place/tiddlers/missing', etag]])
+    response, content = http.request(
+            'http://our_test_domain:8001/etags',
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            body=body)
+    assert response['status'] == '200', content
+
+    results = simplejson.loads(content)
+    assert results['/bags/place/tiddlers/one'] == True
+    assert results['/bags'] == True
+    assert results['/bags/place/tiddlers/two'] == False # from store
+    assert results['/bags/place/tiddlers/missing'] == None
+
+    response, content = http.request(
+            'http://our_test_domain:8001/etags',
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            body='not json')
+    assert response['status'] == '400'
+
+
+def test_negative_cache():
+    config['etagcache.negative_cache'] = True
+    try:
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/place/tiddlers/ghost')
+        assert response['status'] == '404'
+        assert (store.storage.mc.get(_cache_key('/bags/place/tiddlers/ghost'))
+                == NEGATIVE_ENTRY)
+
+        # a planted negative entry for a tiddler that exists can
+        # only be answered by etagcache
+        store.storage.mc.set(_cache_key('/bags/place/tiddlers/two'),
+                NEGATIVE_ENTRY)
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/place/tiddlers/two')
+        assert response['status'] == '404' # from cache
+
+        tiddler = Tiddler('ghost', 'place')
+        tiddler.text = 'boo'
+        store.put(tiddler)
+
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/place/tiddlers/ghost')
+        assert response['status'] == '200' # namespace bumped
+
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/place/tiddlers/two')
+        assert response['status'] == '200' # namespace bumped
+    finally:
+        del config['etagcache.negative_cache']
+
+
+def test_negative_cache_quoted_bag():
+    config['etagcache.negative_cache'] = True
+    try:
+        bag = Bag('my place')
+        store.put(bag)
+
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/my%20place/tiddlers/ghost')
+        assert response['status'] == '404'
+        assert (store.storage.mc.get(
+            _cache_key('/bags/my place/tiddlers/ghost')) == NEGATIVE_ENTRY)
+
+        # known missing is unknown to bulk validation, as from the store
+        response, content = http.request(
+                'http://our_test_domain:8001/etags',
+                method='POST',
+                headers={'Content-Type': 'application/json'},
+                body=simplejson.dumps(
+                    [['/bags/my%20place/tiddlers/ghost', '"x"']]))
+        assert response['status'] == '200', content
+        assert simplejson.loads(content) == {
+                '/bags/my%20place/tiddlers/ghost': None}
+
+        tiddler = Tiddler('ghost', 'my place')
+        tiddler.text = 'boo'
+        store.put(tiddler)
+
+        response, content = http.request(
+                'http://our_test_domain:8001/bags/my%20place/tiddlers/ghost')
+        assert response['status'] == '200' # namespace bumped
+    finally:
+        del config['etagcache.negative_cache']
+
+
+def _cache_key(path, headers=None):
+    environ = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+            'PATH_INFO': path, 'HTTP_HOST': 'our_test_domain:8001',
+            'tiddlyweb.config': config,
+            'tiddlyweb.usersign': {'name': 'GUEST', 'roles': []}}
+    environ.update(headers or {})
+    figure_type(environ)
+    return _make_key(store.storage.mc, environ, _get_uri(environ))
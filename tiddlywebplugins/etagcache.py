@@ -10,28 +10,80 @@ looks up the current URI in the cache and compares the value
 with what's in the If-Match header. If they are the same
 we can raise a 304 right now.
 
+If the request is a PUT or DELETE to a tiddler and includes an
+If-Match header, the cached ETag is used to validate it. A stale
+If-Match gets a 412 without a store read. A confirmed match sets
+tiddlyweb.etagcache.if_match in the environ so downstream
+handlers can skip their own revalidation.
+
+Sync clients may validate many ETags at once by POSTing a JSON
+list of [uri, etag] pairs to /etags (configurable with
+etagcache.validate_uri).
+
 On the response side, if the current request is a GET
 and we put the headers in the cache, with the URI as key.
 On future requests if the incoming headers have an ETag
 we look in the cache.
 
+When etagcache.negative_cache is true, 404 responses to GETs
+are also cached, for etagcache.negative_ttl seconds, and
+repeated GETs for the same URI get a 404 without a store read.
+Creating the missing entity bumps the namespace as usual,
+which invalidates the negative entry.
+
 Store HOOKs are used to invalidate the cache through the
 management of namespaces. Those hooks are activated in
 tiddlywebplugins.cachingstore, not this module.
 
+When etagcache.surrogate_keys is true, cacheable responses get a
+Surrogate-Key header naming their namespace, so a downstream HTTP
+cache can serve full responses. When etagcache.purge_uri is set,
+store HOOKs in this module send batched purges of those keys to
+that uri, at most once every etagcache.purge_interval seconds.
+
+When etagcache.registry is true, a sample (etagcache.registry_sample)
+of cached entries, and of conditional lookups of them, is recorded
+in a registry in the cache, started again every
+etagcache.registry_size records. The twanager commands
+etagcachestats and etagcachenamespaces report on those samples, to
+help size memcached, estimate hit rates and spot key fan-out.
+
+When etagcache.capture names a file, a compact record of each
+request and each store HOOK invalidation is written to it, rotating
+at etagcache.capture_max_bytes. The twanager command
+etagcachesimulate replays captures against alternative cache
+policies and reports projected hit rates and memcached operations.
+
 Installation is simply adding the plugin name to system_plugins
 and twanager_plugins in tiddlywebconfig.py
 """
 
+import cPickle
+import httplib
 import logging
+import logging.handlers
+import socket
+import threading
+import time
 import uuid  # for namespacing
 import urllib
+import urlparse
+
+import simplejson
 
-from httpexceptor import HTTP304, HTTP415
+from httpexceptor import (HTTPException, HTTP304, HTTP400, HTTP404,
+        HTTP412, HTTP415)
 
+from tiddlyweb.control import determine_bag_from_recipe
+from tiddlyweb.manage import make_command
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.policy import PermissionsError
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import HOOKS, NoBagError, NoRecipeError, NoTiddlerError
 from tiddlyweb.util import sha
-from tiddlyweb.web.util import get_serialize_type
-from tiddlyweb.web.negotiate import Negotiate
+from tiddlyweb.web.util import get_serialize_type, tiddler_etag
+from tiddlyweb.web.negotiate import Negotiate, figure_type
 from tiddlywebplugins.caching import (container_namespace_key,
         ANY_NAMESPACE, BAGS_NAMESPACE, RECIPES_NAMESPACE)
 
@@ -39,7 +91,24 @@ from tiddlywebplugins.caching import (container_namespace_key,
 LOGGER = logging.getLogger(__name__)
 HEADERS_304 = ['etag', 'vary', 'cache-control', 'last-modified',
         'content-location', 'expires']
-
+IF_MATCH_METHODS = ['PUT', 'DELETE']
+IF_MATCH_ENVIRON_KEY = 'tiddlyweb.etagcache.if_match'
+ETAG_VALIDATE_URI = '/etags'
+SURROGATE_KEY_HEADER = 'Surrogate-Key'
+PURGE_METHOD = 'PURGE'
+PURGE_INTERVAL = 1.0
+PURGE_TIMEOUT = 5
+NEGATIVE_ENTRY = 'etagcache:404'
+NEGATIVE_TTL = 60
+REGISTRY_KEY = 'etagcache:registry'
+REGISTRY_COUNT_KEY = 'etagcache:registry:count'
+REGISTRY_SAMPLE = 0.1
+REGISTRY_SIZE = 5000
+CAPTURE_LOGGER = logging.getLogger(__name__ + '.capture')
+CAPTURE_MAX_BYTES = 10 * 1024 * 1024
+CAPTURE_BACKUPS = 5
+CAPTURE_RESULTS = {HTTP304: ('hit', '304'), HTTP404: ('negative', '404'),
+        HTTP412: ('conflict', '412')}
 
 class Holder(object):
     """
@@ -53,26 +122,49 @@ class Holder(object):
         self.environ = environ
         self.status = status
         self.headers = headers
+        self.stored = ''
 
     def check_response(self):
         """
         If the current response is in response to a GET then attempt
-        to cache it.
+        to cache it. If negative caching is on, 404s are cached too.
 
         We worry about whether there was an etag on the _next_ request.
         """
-        if (self.environ['REQUEST_METHOD'] == 'GET'
-                and self.status.startswith('200')):
-            uri = _get_uri(self.environ)
-            self._cache(uri)
+        if self.environ['REQUEST_METHOD'] == 'GET':
+            if self.status.startswith('200'):
+                uri = _get_uri(self.environ)
+                self._cache(uri)
+            elif (self.status.startswith('404')
+                    and _negative_cache_enabled(self.environ)):
+                uri = _get_uri(self.environ)
+                self._cache_missing(uri)
 
     def _cache(self, uri):
         """
         Add the uri and etag to the cache.
         """
         LOGGER.debug('adding to cache %s:%s', uri, self.headers)
-        key = _make_key(self.memclient, self.environ, uri)
+        namespace = _get_namespace(self.memclient, self.environ, uri)
+        key = _make_key(self.memclient, self.environ, uri, namespace)
         self.memclient.set(key, self.headers)
+        self.stored = 'set'
+        _register(self.memclient, self.environ, uri, key, self.headers,
+                namespace)
+
+    def _cache_missing(self, uri):
+        """
+        Record that the uri was not found, for a short time.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        LOGGER.debug('adding missing to cache %s', uri)
+        namespace = _get_namespace(self.memclient, self.environ, uri)
+        key = _make_key(self.memclient, self.environ, uri, namespace)
+        self.memclient.set(key, NEGATIVE_ENTRY,
+                time=config.get('etagcache.negative_ttl', NEGATIVE_TTL))
+        self.stored = 'negative'
+        _register(self.memclient, self.environ, uri, key, NEGATIVE_ENTRY,
+                namespace)
 
 
 class EtagCache(object):
@@ -94,7 +186,14 @@ class EtagCache(object):
 
         if _memclient:
             LOGGER.debug('checking cache')
-            _check_cache(_memclient, environ)
+            capturing = bool(CAPTURE_LOGGER.handlers)
+            try:
+                consulted = _check_cache(_memclient, environ)
+            except (HTTP304, HTTP404, HTTP412), exc:
+                if capturing:
+                    result, status = CAPTURE_RESULTS[exc.__class__]
+                    _capture_request(environ, result, status)
+                raise
 
             # Create a holder for response details for this current
             # request.
@@ -104,41 +203,213 @@ class EtagCache(object):
                 """
                 Record status and headers for later manipulation.
                 """
+                _add_surrogate_keys(environ, status, headers)
                 holder.status = status
                 holder.headers = headers
                 return start_response(status, headers, exc_info)
 
-            output = self.application(environ, replacement_start_response)
+            try:
+                output = self.application(environ,
+                        replacement_start_response)
+            except HTTPException, exc:
+                # Handlers report missing entities, and other responses,
+                # by raising, so the response side must see them here.
+                holder.status = exc.status
+                LOGGER.debug('checking raised response')
+                holder.check_response()
+                if capturing:
+                    _capture_request(environ,
+                            _capture_result(environ, consulted),
+                            exc.status, stored=holder.stored)
+                raise
 
             LOGGER.debug('checking response')
             holder.check_response()
 
+            if capturing:
+                _capture_request(environ, _capture_result(environ, consulted),
+                        holder.status, output, holder.stored, holder.headers)
+
             return output
         else:
             return self.application(environ, start_response)
 
 
+class PurgeQueue(object):
+    """
+    Collect surrogate keys invalidated by store HOOKs and send
+    them to the configured purge uri in batches, no more often
+    than once per purge interval.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.timer = None
+        self.last_sent = 0
+
+    def add(self, config, keys):
+        """
+        Queue keys for purging and, if no send is pending, schedule
+        one for when the interval has passed. Sending always happens
+        in the timer thread so store writes are not held up.
+        """
+        interval = config.get('etagcache.purge_interval', PURGE_INTERVAL)
+        with self.lock:
+            self.keys.update(keys)
+            if self.timer:
+                return
+            delay = max(self.last_sent + interval - time.time(), 0)
+            LOGGER.debug('scheduling purge in %s seconds', delay)
+            self.timer = threading.Timer(delay, self.flush, [config])
+            self.timer.start()
+
+    def flush(self, config):
+        """
+        Send all queued keys.
+        """
+        with self.lock:
+            keys = self.keys
+            self.keys = set()
+            self.timer = None
+            self.last_sent = time.time()
+        if keys:
+            _send_purge(config, keys)
+
+
+PURGE_QUEUE = PurgeQueue()
+
+
 def _check_cache(memclient, environ):
     """
     Look in the cache for a match on the current request. That
-    request much be a GET and include an If-None-Match header.
+    request must be a GET and include an If-None-Match header,
+    or be a PUT or DELETE to a tiddler and include an If-Match header.
+
+    If there is a match on a GET, send an immediate 304. If negative
+    caching is on, any GET for a uri known to be missing gets a 404.
 
-    If there is a match, send an immediate 304.
+    Return True if the cache was consulted.
     """
-    if environ['REQUEST_METHOD'] == 'GET':
+    method = environ['REQUEST_METHOD']
+    if method == 'GET':
         uri = _get_uri(environ)
-        LOGGER.debug('with %s %s', uri, environ['REQUEST_METHOD'])
+        LOGGER.debug('with %s %s', uri, method)
         match = environ.get('HTTP_IF_NONE_MATCH', None)
-        if match:
+        negative = _negative_cache_enabled(environ)
+        if match or negative:
             LOGGER.debug('has match %s', match)
             key = _make_key(memclient, environ, uri)
             cached_headers = memclient.get(key)
-            if cached_headers:
-                _testmatch(uri, cached_headers, match)
+            try:
+                if cached_headers == NEGATIVE_ENTRY:
+                    if negative:
+                        LOGGER.debug('cached missing for %s', uri)
+                        raise HTTP404('%s not found' % uri)
+                elif cached_headers and match:
+                    _testmatch(uri, cached_headers, match)
+                    _register_lookup(memclient, environ, key, False)
+                else:
+                    LOGGER.debug('no cached headers for %s', uri)
+            except (HTTP304, HTTP404):
+                _register_lookup(memclient, environ, key, True)
+                raise
+            return True
+        else:
+            LOGGER.debug('no if none match for %s', uri)
+    elif method in IF_MATCH_METHODS:
+        uri = _get_uri(environ)
+        LOGGER.debug('with %s %s', uri, method)
+        match = environ.get('HTTP_IF_MATCH', None)
+        if (match and match != '*'
+                and _tiddler_uri_parts(environ, uri)):
+            LOGGER.debug('has if match %s', match)
+            # A DELETE has no content type to key on, so use the
+            # type a GET with the same Accept header would have.
+            if method == 'DELETE':
+                key = _make_key(memclient, _get_environ(environ), uri)
+            else:
+                key = _make_key(memclient, environ, uri)
+            cached_headers = memclient.get(key)
+            if cached_headers and cached_headers != NEGATIVE_ENTRY:
+                _test_if_match(environ, uri, cached_headers, match)
             else:
                 LOGGER.debug('no cached headers for %s', uri)
+            return True
         else:
-            LOGGER.debug('no if none match for %s', uri)
+            LOGGER.debug('no usable if match for %s', uri)
+    return False
+
+
+def _get_environ(environ):
+    """
+    Return a copy of environ with the serialization type that a
+    GET with the same Accept header would have.
+    """
+    get_environ = dict(environ)
+    get_environ['REQUEST_METHOD'] = 'GET'
+    get_environ.pop('tiddlyweb.type', None)
+    figure_type(get_environ)
+    return get_environ
+
+
+def _test_if_match(environ, uri, cached_headers, match):
+    """
+    If the cached_headers include an Etag, compare its revision
+    portion with the incoming if-match value in match. The portion
+    after the colon varies with user and content type, so, as in
+    TiddlyWeb's own validation, it is not considered.
+
+    If they differ, raise a 412. If they are the same, mark the
+    environ so the downstream handler may skip its own check.
+    """
+    cached_etag = None
+    for name, value in cached_headers:
+        if name.lower() == 'etag':
+            cached_etag = value
+            break
+
+    if not cached_etag:
+        LOGGER.debug('no cached etag for %s', uri)
+        return
+
+    LOGGER.debug('comparing cached %s to if match %s', cached_etag, match)
+    if _etag_revision(cached_etag) == _etag_revision(match):
+        LOGGER.debug('if match confirmed for %s', uri)
+        environ[IF_MATCH_ENVIRON_KEY] = True
+    else:
+        LOGGER.debug('if match failed for %s', uri)
+        raise HTTP412('Provided ETag does not match. '
+                'Server content probably changed.')
+
+
+def _etag_revision(etag):
+    """
+    Return the bag/title/revision portion of a tiddler ETag.
+    """
+    return etag.split(':', 1)[0].strip('"')
+
+
+def _tiddler_uri_parts(environ, uri):
+    """
+    If the uri addresses a single tiddler in a bag or recipe, return
+    a tuple of container type, container name and tiddler title,
+    unquoted. Otherwise return None.
+    """
+    prefix = environ.get('tiddlyweb.config', {}).get('server_prefix', '')
+    uri = uri.split('?', 1)[0]
+    if prefix and uri.startswith(prefix):
+        uri = uri[len(prefix):]
+    uri_parts = uri.split('/')
+    if (len(uri_parts) == 5
+            and uri_parts[1] in ('bags', 'recipes')
+            and uri_parts[2] != ''
+            and uri_parts[3] == 'tiddlers'
+            and uri_parts[4] != ''):
+        return (uri_parts[1],
+                urllib.unquote(uri_parts[2]).decode('UTF-8', 'replace'),
+                urllib.unquote(uri_parts[4]).decode('UTF-8', 'replace'))
+    return None
 
 
 def _testmatch(uri, cached_headers, match):
@@ -180,6 +451,44 @@ def _get_namespace(memclient, environ, uri):
 
     The namespace is built from the current URI.
     """
+    return _get_namespaces(memclient, environ, [uri])[uri]
+
+
+def _get_namespaces(memclient, environ, uris):
+    """
+    Calculate the namespaces for several uris with one cache
+    lookup, returning a dict of uri to namespace.
+    """
+    keys = dict((uri, _namespace_key(environ, uri)) for uri in uris)
+    namespaces = memclient.get_multi(list(set(keys.values())))
+
+    results = {}
+    for uri, key in keys.items():
+        namespace = namespaces.get(key)
+        if not namespace:
+            namespace = '%s' % uuid.uuid4()
+            LOGGER.debug('no namespace for %s, setting to %s', key, namespace)
+            memclient.set(key.encode('utf8'), namespace)
+            namespaces[key] = namespace
+        LOGGER.debug('current namespace %s:%s', key, namespace)
+        results[uri] = namespace
+    return results
+
+
+def _namespace_key(environ, uri):
+    """
+    Calculate the key of the container namespace for uri.
+    """
+    return container_namespace_key(*_namespace_parts(environ, uri)[1])
+
+
+def _namespace_parts(environ, uri):
+    """
+    Classify uri, returning the class of its namespace (one of bag,
+    recipe, bags, recipes or any) and the arguments with which to
+    build its namespace key. Bag and recipe names are unquoted to
+    UTF-8, to match the keys the caching store hooks reset.
+    """
     prefix = environ.get('tiddlyweb.config', {}).get('server_prefix', '')
 
     index = 0
@@ -190,34 +499,295 @@ def _get_namespace(memclient, environ, uri):
 
     if '/bags/' in uri:
         container = uri_parts[1]
-        bag_name = uri_parts[2]
-        key = container_namespace_key(container, bag_name)
+        bag_name = urllib.unquote(uri_parts[2])
+        return 'bag', (container, bag_name)
     elif '/recipes/' in uri:
         if '/tiddlers' in uri:
-            key = container_namespace_key(ANY_NAMESPACE)
+            return 'any', (ANY_NAMESPACE,)
         else:
             container = uri_parts[1]
-            recipe_name = uri_parts[2]
-            key = container_namespace_key(container, recipe_name)
+            recipe_name = urllib.unquote(uri_parts[2])
+            return 'recipe', (container, recipe_name)
     # bags or recipes
     elif '/bags' in uri:
-        key = container_namespace_key(BAGS_NAMESPACE)
+        return 'bags', (BAGS_NAMESPACE,)
     elif '/recipes' in uri:
-        key = container_namespace_key(RECIPES_NAMESPACE)
+        return 'recipes', (RECIPES_NAMESPACE,)
     # anything that didn't already match, like friendly uris or
     # search
     else:
-        key = container_namespace_key(ANY_NAMESPACE)
+        return 'any', (ANY_NAMESPACE,)
+
+
+def _register(memclient, environ, uri, key, value, namespace):
+    """
+    If the registry is on and the entry key is in the sample, record
+    the cache entry as a tab separated line in the registry. The
+    container is recorded readably, as the namespace key is a digest.
+    """
+    config = environ.get('tiddlyweb.config', {})
+    if not _sampled(config, key):
+        return
+    namespace_class, namespace_args = _namespace_parts(environ, uri)
+    namespace_key = container_namespace_key(*namespace_args)
+    if len(namespace_args) > 1:
+        container = '/'.join(namespace_args)
+    else:
+        container = namespace_class
+    record = 'entry\t%s\t%s\t%s\t%s\t%s\t%d\t%d\n' % (key,
+            namespace_class, _surrogate_key(container),
+            _surrogate_key(namespace_key), namespace,
+            len(cPickle.dumps(value)), int(time.time()))
+    _registry_append(memclient, config, record)
+
+
+def _register_lookup(memclient, environ, key, hit):
+    """
+    If the registry is on and the entry key is in the sample, record
+    a conditional lookup that found the entry, and whether it was
+    answered from the cache.
+    """
+    config = environ.get('tiddlyweb.config', {})
+    if not _sampled(config, key):
+        return
+    _registry_append(memclient, config, 'lookup\t%s\t%d\n' % (key,
+        hit and 1 or 0))
+
+
+def _sampled(config, key):
+    """
+    Decide from the entry key whether it is in the registry sample,
+    so storing and looking up an entry agree without asking the cache.
+    """
+    if not config.get('etagcache.registry'):
+        return False
+    return int(key[:8], 16) < (config.get('etagcache.registry_sample',
+        REGISTRY_SAMPLE) * 0x100000000)
+
+
+def _registry_append(memclient, config, record):
+    """
+    Append a record to the registry. When the registry holds
+    etagcache.registry_size records, is missing, or will not take
+    the append, it is started again with this record.
+    """
+    count = memclient.incr(REGISTRY_COUNT_KEY)
+    if (count and count <= config.get('etagcache.registry_size',
+            REGISTRY_SIZE) and memclient.append(REGISTRY_KEY, record)):
+        return
+    memclient.set(REGISTRY_KEY, record)
+    memclient.set(REGISTRY_COUNT_KEY, 1)
+
+
+def _start_capture(config):
+    """
+    Send capture records to the rotating file named in config.
+    """
+    handler = logging.handlers.RotatingFileHandler(
+            config['etagcache.capture'],
+            maxBytes=config.get('etagcache.capture_max_bytes',
+                CAPTURE_MAX_BYTES),
+            backupCount=config.get('etagcache.capture_backups',
+                CAPTURE_BACKUPS))
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    CAPTURE_LOGGER.addHandler(handler)
+    CAPTURE_LOGGER.setLevel(logging.INFO)
+    CAPTURE_LOGGER.propagate = False
+
+
+def _capture(record):
+    """
+    Write one capture record as a line of JSON.
+    """
+    CAPTURE_LOGGER.info(simplejson.dumps(record, separators=(',', ':')))
+
+
+def _capture_result(environ, consulted):
+    """
+    The cache result of a request that the cache did not answer.
+    """
+    if environ.get(IF_MATCH_ENVIRON_KEY):
+        return 'confirmed'
+    elif consulted:
+        return 'miss'
+    return 'pass'
+
+
+def _capture_request(environ, result, status, output=None, stored='',
+        headers=None):
+    """
+    Capture a request record: a list of 'r', time, method, whether
+    the request was conditional, status code, cache result (hit,
+    negative, conflict, confirmed, miss or pass), namespace class,
+    namespace key, and the mime type, username, host and uri used
+    in the cache key, the response size (-1 if unknown), what, if
+    anything, was stored in the cache, and whether an If-None-Match
+    matched the current ETag.
+    """
+    uri = _get_uri(environ)
+    namespace_class, namespace_args = _namespace_parts(environ, uri)
+    conditional = bool(environ.get('HTTP_IF_NONE_MATCH')
+            or environ.get('HTTP_IF_MATCH'))
+    if isinstance(output, list):
+        size = sum(len(chunk) for chunk in output)
+    else:
+        size = -1
+    _capture(['r', round(time.time(), 3), environ['REQUEST_METHOD'],
+        int(conditional), int((status or '0').split(' ', 1)[0]), result,
+        namespace_class,
+        _surrogate_key(container_namespace_key(*namespace_args)),
+        _get_mime_type(environ, uri),
+        environ['tiddlyweb.usersign']['name'],
+        environ.get('HTTP_HOST', ''), uri.decode('UTF-8', 'replace'),
+        size, stored, int(_tag_matched(environ, status or '', headers))])
+
+
+def _tag_matched(environ, status, headers):
+    """
+    True if the request's If-None-Match is the current ETag, either
+    because the response is a 304 or because it carries that ETag.
+    """
+    match = environ.get('HTTP_IF_NONE_MATCH')
+    if not match:
+        return False
+    if status.startswith('304'):
+        return True
+    for name, value in headers or []:
+        if name.lower() == 'etag':
+            return value == match
+    return False
+
+
+def _negative_cache_enabled(environ):
+    """
+    True if 404 responses should be cached.
+    """
+    return environ.get('tiddlyweb.config', {}).get(
+            'etagcache.negative_cache', False)
+
+
+def _add_surrogate_keys(environ, status, headers):
+    """
+    If configured, add a surrogate key header to a cacheable
+    response, naming the namespace of the current uri.
+    """
+    config = environ.get('tiddlyweb.config', {})
+    if (config.get('etagcache.surrogate_keys')
+            and environ['REQUEST_METHOD'] == 'GET'
+            and status.startswith('200')):
+        uri = _get_uri(environ)
+        headers.append((
+            config.get('etagcache.surrogate_key_header',
+                SURROGATE_KEY_HEADER),
+            _surrogate_key(_namespace_key(environ, uri))))
+
+
+def _surrogate_key(namespace_key):
+    """
+    Make a namespace key safe for use in a space separated header.
+    """
+    if isinstance(namespace_key, unicode):
+        namespace_key = namespace_key.encode('UTF-8')
+    return urllib.quote(namespace_key, safe='')
+
+
+def _send_purge(config, keys):
+    """
+    Send one purge request naming keys to the configured purge uri.
+    Failures are logged, not raised: the downstream cache is only
+    an optimization.
+    """
+    purge_uri = config.get('etagcache.purge_uri')
+    if not purge_uri:
+        return
+    header = config.get('etagcache.purge_header',
+            config.get('etagcache.surrogate_key_header',
+                SURROGATE_KEY_HEADER))
+    method = config.get('etagcache.purge_method', PURGE_METHOD)
+    parsed = urlparse.urlsplit(purge_uri)
+    if parsed.scheme == 'https':
+        connection = httplib.HTTPSConnection(parsed.netloc,
+                timeout=PURGE_TIMEOUT)
+    else:
+        connection = httplib.HTTPConnection(parsed.netloc,
+                timeout=PURGE_TIMEOUT)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    LOGGER.debug('purging %s at %s', keys, purge_uri)
+    try:
+        try:
+            connection.request(method, path,
+                    headers={header: ' '.join(sorted(keys))})
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                LOGGER.warn('purge to %s failed with %s',
+                        purge_uri, response.status)
+        except (httplib.HTTPException, socket.error), exc:
+            LOGGER.warn('unable to purge %s: %s', purge_uri, exc)
+    finally:
+        connection.close()
+
+
+def _bag_changed(store, bag):
+    """
+    Store HOOK for a bag, which affects the bag, the bags list and
+    anything else.
+    """
+    _invalidate(store, [
+        ('bag', ('bags', _encode_name(bag.name))),
+        ('bags', (BAGS_NAMESPACE,)),
+        ('any', (ANY_NAMESPACE,))])
+
 
-    namespace = memclient.get(key)
-    if not namespace:
-        namespace = '%s' % uuid.uuid4()
-        LOGGER.debug('no namespace for %s, setting to %s', key, namespace)
-        memclient.set(key.encode('utf8'), namespace)
+def _recipe_changed(store, recipe):
+    """
+    Store HOOK for a recipe, which affects the recipe, the recipes
+    list and anything else.
+    """
+    _invalidate(store, [
+        ('recipe', ('recipes', _encode_name(recipe.name))),
+        ('recipes', (RECIPES_NAMESPACE,)),
+        ('any', (ANY_NAMESPACE,))])
 
-    LOGGER.debug('current namespace %s:%s', key, namespace)
 
-    return namespace
+def _tiddler_changed(store, tiddler):
+    """
+    Store HOOK for a tiddler, which affects its bag and anything else.
+    """
+    _invalidate(store, [
+        ('bag', ('bags', _encode_name(tiddler.bag))),
+        ('any', (ANY_NAMESPACE,))])
+
+
+def _encode_name(name):
+    """
+    Encode a bag or recipe name as UTF-8, as _namespace_parts
+    leaves names unquoted from uris, so the keys match.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('UTF-8')
+    return name
+
+
+def _invalidate(store, namespaces):
+    """
+    Given a list of namespace class and namespace key argument
+    pairs, queue purges of their surrogate keys, if purging is
+    configured, and capture the event, if capturing.
+    """
+    config = store.environ.get('tiddlyweb.config', {})
+    if not (config.get('etagcache.purge_uri') or CAPTURE_LOGGER.handlers):
+        return
+    surrogate_keys = [_surrogate_key(container_namespace_key(*args))
+            for _, args in namespaces]
+    if config.get('etagcache.purge_uri'):
+        PURGE_QUEUE.add(config, surrogate_keys)
+    if CAPTURE_LOGGER.handlers:
+        _capture(['i', round(time.time(), 3),
+            [[namespace_class, key] for (namespace_class, _), key
+                in zip(namespaces, surrogate_keys)]])
 
 
 def _get_uri(environ):
@@ -231,11 +801,28 @@ def _get_uri(environ):
     return uri
 
 
-def _make_key(memclient, environ, uri):
+def _make_key(memclient, environ, uri, namespace=None):
     """
     Build a key for the current request. The key is a combination
     of the current namespace, the current content type, the current
     user, the host, and the uri.
+
+    If namespace is not provided it is looked up in the cache.
+    """
+    mime_type = _get_mime_type(environ, uri)
+    username = environ['tiddlyweb.usersign']['name']
+    if namespace is None:
+        namespace = _get_namespace(memclient, environ, uri)
+    host = environ.get('HTTP_HOST', '')
+    uri = uri.decode('UTF-8', 'replace')
+    key = '%s:%s:%s:%s:%s' % (namespace, mime_type, username, host, uri)
+    return sha(key.encode('UTF-8')).hexdigest()
+
+
+def _get_mime_type(environ, uri):
+    """
+    Determine the serialization mime type for the current request,
+    falling back to that of the default serializer.
     """
     try:
         mime_type = get_serialize_type(environ)[1]
@@ -246,23 +833,137 @@ def _make_key(memclient, environ, uri):
         serializers = config['serializers']
         mime_type = serializers[default_serializer][1]
     LOGGER.debug('mime_type %s for %s', mime_type, uri)
-    username = environ['tiddlyweb.usersign']['name']
-    namespace = _get_namespace(memclient, environ, uri)
-    host = environ.get('HTTP_HOST', '')
-    uri = uri.decode('UTF-8', 'replace')
-    key = '%s:%s:%s:%s:%s' % (namespace, mime_type, username, host, uri)
-    return sha(key.encode('UTF-8')).hexdigest()
+    return mime_type
+
+
+def validate_etags(environ, start_response):
+    """
+    Validate a batch of uri and etag pairs, sent as a JSON list of
+    two item lists in a POST body. The uris are paths as they would
+    be requested, and keys are built as they would be for a GET with
+    the Accept header of this request.
+
+    The response is a JSON object mapping each uri to true if the
+    etag is current, false if it is not, or null if that could not
+    be determined. The cache is consulted with a single get_multi,
+    and the store only for tiddlers missing from the cache.
+    """
+    try:
+        length = int(environ['CONTENT_LENGTH'])
+        pairs = simplejson.loads(environ['wsgi.input'].read(length))
+        pairs = [(str(uri), etag) for uri, etag in pairs]
+    except (KeyError, ValueError, TypeError, UnicodeError), exc:
+        raise HTTP400('unable to parse etag list: %s' % exc)
+
+    get_environ = _get_environ(environ)
+
+    try:
+        memclient = environ['tiddlyweb.store'].storage.mc
+    except AttributeError:
+        memclient = None
+
+    cached_etags = {}
+    if memclient:
+        namespaces = _get_namespaces(memclient, get_environ,
+                [uri for uri, _ in pairs])
+        keys = dict((uri, _make_key(memclient, get_environ, uri,
+            namespaces[uri])) for uri, _ in pairs)
+        cached = memclient.get_multi(list(set(keys.values())))
+        for uri, key in keys.items():
+            if cached.get(key) == NEGATIVE_ENTRY:
+                cached_etags[uri] = NEGATIVE_ENTRY
+                continue
+            for name, value in cached.get(key) or []:
+                if name.lower() == 'etag':
+                    cached_etags[uri] = value
+                    break
+
+    results = {}
+    for uri, etag in pairs:
+        current_etag = cached_etags.get(uri)
+        if current_etag is None:
+            LOGGER.debug('bulk validation miss for %s', uri)
+            current_etag = _store_etag(get_environ, uri)
+        # Missing entities are unknown, whether cached or from the store.
+        if current_etag is None or current_etag == NEGATIVE_ENTRY:
+            results[uri] = None
+        else:
+            results[uri] = current_etag == etag
+
+    start_response('200 OK', [
+        ('Content-Type', 'application/json; charset=UTF-8'),
+        ('Cache-Control', 'no-cache')])
+    return [simplejson.dumps(results)]
+
+
+def _store_etag(environ, uri):
+    """
+    Calculate the current etag of the tiddler at uri from the store.
+    Return None if uri is not a tiddler uri, or if the tiddler is
+    missing or not readable by the current user.
+    """
+    parts = _tiddler_uri_parts(environ, uri)
+    if not parts:
+        return None
+    container, name, title = parts
+    store = environ['tiddlyweb.store']
+    usersign = environ['tiddlyweb.usersign']
+    tiddler = Tiddler(title)
+    try:
+        if container == 'recipes':
+            recipe = store.get(Recipe(name))
+            recipe.policy.allows(usersign, 'read')
+            bag = determine_bag_from_recipe(recipe, tiddler, environ)
+        else:
+            bag = store.get(Bag(name))
+        bag.policy.allows(usersign, 'read')
+        tiddler.bag = bag.name
+        tiddler = store.get(tiddler)
+    except (NoBagError, NoRecipeError, NoTiddlerError, PermissionsError):
+        return None
+    return tiddler_etag(environ, tiddler)
 
 
 def init(config):
     """
     Initialize and configure the plugin. If selector, we are on
-    the web server side and need to adjust filters. The rest is
+    the web server side and need to adjust filters. Otherwise we
+    are in twanager and add the inspection commands. The rest is
     for both system and twanager plugins: hooks used to invalidate
     the cache.
     """
     if 'selector' in config:
+        config['selector'].add(
+                config.get('etagcache.validate_uri', ETAG_VALIDATE_URI),
+                POST=validate_etags)
         if EtagCache not in config['server_request_filters']:
             config['server_request_filters'].insert(
                     config['server_request_filters'].index(Negotiate) + 1,
                     EtagCache)
+    else:
+        from tiddlywebplugins.etagcachetools import (report_stats,
+                report_namespaces, report_simulation)
+
+        @make_command()
+        def etagcachestats(args):
+            """Report sampled etag cache entries by namespace class"""
+            report_stats(config)
+
+        @make_command()
+        def etagcachenamespaces(args):
+            """Report etag cache namespace generations"""
+            report_namespaces(config)
+
+        @make_command()
+        def etagcachesimulate(args):
+            """Simulate etag cache policies: <capture file>... [policy]..."""
+            report_simulation(config, args)
+
+    if config.get('etagcache.capture') and not CAPTURE_LOGGER.handlers:
+        _start_capture(config)
+
+    for entity, hook in [('bag', _bag_changed),
+            ('recipe', _recipe_changed), ('tiddler', _tiddler_changed)]:
+        for action in ['put', 'delete']:
+            if hook not in HOOKS[entity][action]:
+                HOOKS[entity][action].append(hook)
@@ -0,0 +1,401 @@
+"""
+Inspection and simulation for the etag cache, used by the twanager
+commands etagcachestats, etagcachenamespaces and etagcachesimulate.
+
+The reports read the registry kept in memcached when
+etagcache.registry is on. The simulator replays files written when
+etagcache.capture is set against alternative cache policies.
+"""
+
+import logging
+import sys
+import time
+import urllib
+
+from collections import OrderedDict
+
+import simplejson
+
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.etagcache import (NEGATIVE_ENTRY, NEGATIVE_TTL,
+        REGISTRY_KEY, REGISTRY_SAMPLE)
+
+
+LOGGER = logging.getLogger(__name__)
+SIMULATION_POLICY = {'granularity': 'container', 'ttl': 0,
+        'admission': 'all', 'l1': 0, 'negative': False,
+        'negative_ttl': NEGATIVE_TTL}
+SIMULATION_CHOICES = {'granularity': ['container', 'class', 'global'],
+        'admission': ['all', 'second']}
+
+
+def _read_registry(memclient):
+    """
+    Return the registry records as a dict of entry key to a tuple
+    of namespace class, container, namespace key, namespace, size
+    and time, keeping the latest record for each entry key, and a
+    dict of entry key to a list of lookup and hit counts.
+    """
+    records = {}
+    lookups = {}
+    for line in (memclient.get(REGISTRY_KEY) or '').splitlines():
+        try:
+            fields = line.split('\t')
+            if fields[0] == 'lookup':
+                _, key, hit = fields
+                counts = lookups.setdefault(key, [0, 0])
+                counts[0] += 1
+                counts[1] += int(hit)
+            else:
+                (_, key, namespace_class, container, namespace_key,
+                        namespace, size, stamp) = fields
+                records[key] = (namespace_class, urllib.unquote(container),
+                        urllib.unquote(namespace_key), namespace, int(size),
+                        int(stamp))
+        except ValueError:
+            LOGGER.debug('skipping bad registry record %s', line)
+    return records, lookups
+
+
+def _classify_registry(memclient, records):
+    """
+    Compare registry records with the cache, returning a list of
+    tuples of entry key, record and state, where state is live,
+    stale (the namespace has moved on) or evicted.
+    """
+    namespaces = memclient.get_multi(
+            list(set(record[2] for record in records.values())))
+    present = memclient.get_multi(records.keys())
+    results = []
+    for key, record in records.items():
+        if namespaces.get(record[2]) != record[3]:
+            state = 'stale'
+        elif key not in present:
+            state = 'evicted'
+        else:
+            state = 'live'
+        results.append((key, record, state))
+    return results
+
+
+def _twanager_memclient(config):
+    """
+    Get the memcached client of the configured store, or None.
+    """
+    store = Store(config['server_store'][0], config['server_store'][1],
+            environ={'tiddlyweb.config': config})
+    try:
+        return store.storage.mc
+    except AttributeError:
+        print >> sys.stderr, 'server_store does not use memcached'
+        return None
+
+
+def report_stats(config):
+    """
+    Print counts, sizes, ages and the share still live of registry
+    entries by namespace class, with estimates of the whole cache,
+    and how many conditional lookups of those entries were answered
+    from the cache.
+    """
+    memclient = _twanager_memclient(config)
+    if not memclient:
+        return
+    records, lookups = _read_registry(memclient)
+    if not records:
+        print >> sys.stderr, 'no registry entries, is etagcache.registry on?'
+        return
+    sample = config.get('etagcache.registry_sample', REGISTRY_SAMPLE)
+    now = time.time()
+
+    stats = {}
+    for key, record, state in _classify_registry(memclient, records):
+        namespace_class, _, _, _, size, stamp = record
+        counts = stats.setdefault(namespace_class, {'sampled': 0,
+            'live': 0, 'stale': 0, 'evicted': 0, 'bytes': 0, 'age': 0,
+            'lookups': 0, 'hits': 0})
+        counts['sampled'] += 1
+        counts[state] += 1
+        if state == 'live':
+            counts['bytes'] += size
+            counts['age'] += now - stamp
+        entry_lookups, entry_hits = lookups.get(key, (0, 0))
+        counts['lookups'] += entry_lookups
+        counts['hits'] += entry_hits
+
+    print ('%-8s %8s %8s %8s %8s %10s %8s %10s %12s %7s %8s %8s %10s '
+            '%6s' % ('class', 'sampled', 'live', 'stale', 'evicted',
+                'live bytes', 'mean age', 'est. live', 'est. bytes',
+                'live %', 'lookups', 'hits', 'est. hits', 'hit %'))
+    for namespace_class in sorted(stats):
+        counts = stats[namespace_class]
+        if not counts['sampled']:
+            continue
+        live = counts['live']
+        print ('%-8s %8d %8d %8d %8d %10d %7ds %10d %12d %6d%% %8d %8d '
+                '%10d %5d%%' % (namespace_class, counts['sampled'], live,
+                    counts['stale'], counts['evicted'], counts['bytes'],
+                    live and counts['age'] / live,
+                    live / sample, counts['bytes'] / sample,
+                    100 * live / counts['sampled'], counts['lookups'],
+                    counts['hits'], counts['hits'] / sample,
+                    counts['lookups']
+                    and 100 * counts['hits'] / counts['lookups']))
+
+
+def report_namespaces(config):
+    """
+    Print current generation and sample counts for each namespace
+    seen in the registry.
+    """
+    memclient = _twanager_memclient(config)
+    if not memclient:
+        return
+    records, _ = _read_registry(memclient)
+    namespaces = {}
+    for key, record, state in _classify_registry(memclient, records):
+        namespace_class, container, namespace_key, namespace = record[:4]
+        info = namespaces.setdefault(namespace_key, {
+            'class': namespace_class, 'container': container,
+            'generations': set(), 'live': 0, 'sampled': 0})
+        info['generations'].add(namespace)
+        info['sampled'] += 1
+        if state == 'live':
+            info['live'] += 1
+    current = memclient.get_multi(namespaces.keys())
+
+    print '%-8s %-36s %6s %8s %6s %s' % ('class', 'generation', 'seen',
+            'sampled', 'live', 'container')
+    for namespace_key in sorted(namespaces,
+            key=lambda key: -namespaces[key]['sampled']):
+        info = namespaces[namespace_key]
+        print '%-8s %-36s %6d %8d %6d %s' % (info['class'],
+                current.get(namespace_key, '-'), len(info['generations']),
+                info['sampled'], info['live'],
+                info['container'].decode('UTF-8', 'replace'))
+
+
+class CacheSimulator(object):
+    """
+    Replay capture records against a cache policy, counting
+    lookups, hits, sets and memcached operations. The policy
+    keys are those in SIMULATION_POLICY:
+
+    granularity: container (as now), class (one namespace per
+    namespace class) or global (one namespace for everything).
+    ttl: seconds before entries expire, 0 for never.
+    admission: all, or second to cache only keys seen before.
+    l1: size of an in process LRU in front of memcached, 0 for none.
+    negative, negative_ttl: whether and how long to cache 404s.
+    """
+
+    def __init__(self, policy):
+        self.policy = dict(SIMULATION_POLICY)
+        self.policy.update(policy)
+        self.generations = {}
+        self.entries = {}
+        self.seen = set()
+        self.l1 = OrderedDict()
+        self.counts = dict((name, 0) for name in ['requests', 'lookups',
+            'hits', 'negative_hits', 'l1_hits', 'sets', 'ops'])
+
+    def feed(self, record):
+        """
+        Process one capture record.
+        """
+        if record[0] == 'i':
+            for namespace_class, namespace_key in record[2]:
+                namespace = self._namespace(namespace_class, namespace_key)
+                self.generations[namespace] = (
+                        self.generations.get(namespace, 0) + 1)
+        elif record[0] == 'r' and record[2] == 'GET':
+            self._request(record)
+
+    def _namespace(self, namespace_class, namespace_key):
+        """
+        The simulated namespace for a namespace class and key.
+        """
+        granularity = self.policy['granularity']
+        if granularity == 'global':
+            return ''
+        elif granularity == 'class':
+            return namespace_class
+        return namespace_key
+
+    def _request(self, record):
+        """
+        Simulate a GET, first its cache check, then its response.
+        """
+        (_, now, _, conditional, status, result, namespace_class,
+                namespace_key, mime_type, username, host, uri, _, _,
+                matched) = record[:15]
+        self.counts['requests'] += 1
+        namespace = self._namespace(namespace_class, namespace_key)
+        key = (namespace, self.generations.get(namespace, 0), mime_type,
+                username, host, uri)
+
+        # What the application would have said without the cache.
+        if result == 'hit':
+            status = 200
+        elif result == 'negative':
+            status = 404
+
+        if conditional or self.policy['negative']:
+            self.counts['lookups'] += 1
+            entry = self._get(key, now)
+            if entry == NEGATIVE_ENTRY:
+                if self.policy['negative']:
+                    self.counts['negative_hits'] += 1
+                    return
+            elif entry and conditional and matched:
+                # Like _testmatch, only a current tag gets a 304.
+                self.counts['hits'] += 1
+                return
+
+        if status == 200:
+            self._set(key, 'headers', now, self.policy['ttl'])
+        elif status == 404 and self.policy['negative']:
+            self._set(key, NEGATIVE_ENTRY, now, self.policy['negative_ttl'])
+
+    def _get(self, key, now):
+        """
+        Look up key, in the L1 and then memcached, counting
+        operations. The namespace is always fetched from memcached.
+        """
+        self.counts['ops'] += 1
+        if key in self.l1:
+            value, expires = self.l1.pop(key)
+            if not expires or expires > now:
+                self.counts['l1_hits'] += 1
+                self.l1[key] = (value, expires)
+                return value
+        self.counts['ops'] += 1
+        value, expires = self.entries.get(key, (None, None))
+        if expires and expires <= now:
+            del self.entries[key]
+            return None
+        if value is not None:
+            self._l1_add(key, value, expires)
+        return value
+
+    def _set(self, key, value, now, ttl):
+        """
+        Store key, subject to admission, counting the namespace
+        fetch and the set.
+        """
+        if self.policy['admission'] == 'second' and key not in self.seen:
+            self.seen.add(key)
+            return
+        self.counts['sets'] += 1
+        self.counts['ops'] += 2
+        expires = ttl and now + ttl or None
+        self.entries[key] = (value, expires)
+        self._l1_add(key, value, expires)
+
+    def _l1_add(self, key, value, expires):
+        """
+        Add to the L1, dropping the least recently used if full.
+        """
+        if self.policy['l1']:
+            self.l1.pop(key, None)
+            self.l1[key] = (value, expires)
+            if len(self.l1) > self.policy['l1']:
+                self.l1.popitem(last=False)
+
+    def report(self):
+        """
+        Return the counts with hit rate and operations per request.
+        """
+        report = dict(self.counts)
+        report['hit_rate'] = (float(self.counts['hits']
+            + self.counts['negative_hits'])
+            / (self.counts['lookups'] or 1))
+        report['ops_per_request'] = (float(self.counts['ops'])
+            / (self.counts['requests'] or 1))
+        return report
+
+
+def read_capture(filenames):
+    """
+    Yield capture records from filenames, in the order given.
+    """
+    for filename in filenames:
+        capture = open(filename)
+        try:
+            for line in capture:
+                try:
+                    yield simplejson.loads(line)
+                except ValueError:
+                    LOGGER.debug('skipping bad capture line %s', line)
+        finally:
+            capture.close()
+
+
+def parse_policy(text):
+    """
+    Parse a policy of the form name=value,name=value, raising
+    ValueError for unknown settings or values.
+    """
+    policy = {}
+    for item in text.split(','):
+        name, value = item.split('=', 1)
+        if name not in SIMULATION_POLICY:
+            raise ValueError('unknown policy setting %s' % name)
+        default = SIMULATION_POLICY[name]
+        if isinstance(default, bool):
+            value = value.lower() in ('1', 'true', 'yes', 'on')
+        elif isinstance(default, int):
+            value = int(value)
+        elif value not in SIMULATION_CHOICES.get(name, [value]):
+            raise ValueError('%s must be one of %s' % (name,
+                ', '.join(SIMULATION_CHOICES[name])))
+        policy[name] = value
+    return policy
+
+
+def report_simulation(config, args):
+    """
+    Replay the capture files named in args against the current
+    policy and any given policies, printing the projections.
+    """
+    filenames = [arg for arg in args if '=' not in arg]
+    if not filenames:
+        print >> sys.stderr, 'name at least one capture file'
+        return
+    try:
+        policies = [('current', {'negative': bool(config.get(
+            'etagcache.negative_cache', False)),
+            'negative_ttl': config.get('etagcache.negative_ttl',
+                NEGATIVE_TTL)})]
+        policies.extend((arg, parse_policy(arg))
+                for arg in args if '=' in arg)
+    except ValueError, exc:
+        print >> sys.stderr, 'bad policy: %s' % exc
+        return
+
+    simulators = [(name, CacheSimulator(policy))
+            for name, policy in policies]
+    observed = {'lookups': 0, 'hits': 0}
+    for record in read_capture(filenames):
+        if record[0] == 'r' and record[2] == 'GET':
+            if record[5] in ('hit', 'negative', 'miss'):
+                observed['lookups'] += 1
+            if record[5] in ('hit', 'negative'):
+                observed['hits'] += 1
+        for _, simulator in simulators:
+            simulator.feed(record)
+
+    print 'observed: %d lookups, %d hits, %.1f%% hit rate' % (
+            observed['lookups'], observed['hits'],
+            100.0 * observed['hits'] / (observed['lookups'] or 1))
+    print '%8s %8s %8s %8s %8s %8s %8s %8s  %s' % ('requests', 'lookups',
+            'hits', '404 hits', 'l1 hits', 'sets', 'ops', 'hit %',
+            'policy')
+    for name, simulator in simulators:
+        report = simulator.report()
+        print '%8d %8d %8d %8d %8d %8d %8d %7.1f%%  %s' % (
+                report['requests'], report['lookups'], report['hits'],
+                report['negative_hits'], report['l1_hits'],
+                report['sets'], report['ops'], 100 * report['hit_rate'],
+                name)